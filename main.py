@@ -1,20 +1,40 @@
-from datetime import datetime, timedelta, timezone
+import hashlib
+import hmac
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections.abc import Mapping
 from typing import Annotated
+from urllib.parse import parse_qsl
+from warnings import deprecated
 
-import jwt
+import orjson
 from fastapi import (
     Depends,
     FastAPI,
     HTTPException,
+    Request,
     status,
 )
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from fastapi.security import OAuth2PasswordBearer
 from pwdlib import PasswordHash
-from pydantic import BaseModel
+from pwdlib.hashers.argon2 import Argon2Hasher
+from pydantic import BaseModel, Field, ValidationError
 
 SECRET_KEY = "4190fc2a5ca3c5813532f5c06a349fff6d3a46290fc55b9809f4ef9b007b5487"
-ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+DEFAULT_TOKEN_EXPIRE_SECONDS = 15 * 60
+
+JWT_KEY = SECRET_KEY.encode("ascii")
+# base64url('{"alg":"HS256","typ":"JWT"}'), the only header we issue or accept.
+JWT_HEADER_SEGMENT = b"eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9"
+JWT_MAX_LENGTH = 4096
+
+# Same cap Starlette's form parser applies to multipart bodies.
+LOGIN_FORM_MAX_FIELDS = 1000
 
 fake_users_db: dict = {
     "johndoe": {
@@ -32,8 +52,10 @@ class Token(BaseModel):
     token_type: str
 
 
-class TokenData(BaseModel):
-    username: str | None = None
+class LoginForm(BaseModel):
+    username: str
+    password: str
+    grant_type: str | None = Field(None, pattern="^password$")
 
 
 class User(BaseModel):
@@ -47,105 +69,250 @@ class UserInDB(User):
     hashed_password: str
 
 
-password_hash = PasswordHash.recommended()
+user_cache: dict[str, UserInDB] = {}
+
+
+def validate_users(db: dict) -> None:
+    for row in db.values():
+        UserInDB.model_validate(row)
+
+
+# get_user trusts stored rows and skips validation, so check the seed data once.
+validate_users(fake_users_db)
+
+
+# OWASP minimum for Argon2id: 19 MiB, 2 iterations, 1 lane.
+password_hash = PasswordHash(
+    (Argon2Hasher(memory_cost=19456, time_cost=2, parallelism=1),)
+)
+# Hashed at startup so it always matches the current Argon2 parameters.
+DUMMY_PASSWORD_HASH = password_hash.hash("not-a-real-password")
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl="token")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return password_hash.verify(plain_password, hashed_password)
+def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, str | None]:
+    if not hashed_password.startswith("$argon2id$"):
+        return False, None
+    return password_hash.verify_and_update(plain_password, hashed_password)
 
 
 def hash_password(password: str) -> str:
     return password_hash.hash(password)
 
 
-def get_user(db, username: str | None) -> UserInDB | None:
-    if username not in db:
-        return None
-
-    user_dict = db[username]
-    return UserInDB(**user_dict)
+def get_user(db, username: str) -> UserInDB | None:
+    user = user_cache.get(username)
+    if user is None:
+        user_dict = db.get(username)
+        if user_dict is None:
+            return None
+        user = UserInDB.model_construct(**user_dict)
+        user_cache[username] = user
+    return user
 
 
-def authenticate_user(fake_db: dict, username: str, password: str) -> UserInDB | None:
+async def authenticate_user(
+    fake_db: dict, username: str, password: str
+) -> UserInDB | None:
     user = get_user(fake_db, username)
     if not user:
+        # Burn the same Argon2 work so response times don't reveal which
+        # usernames exist.
+        await run_in_threadpool(
+            verify_and_update_password, password, DUMMY_PASSWORD_HASH
+        )
         return None
-    if not verify_password(password, user.hashed_password):
+    # Argon2 is deliberately slow and memory-hard, keep it off the event loop.
+    verified, updated_hash = await run_in_threadpool(
+        verify_and_update_password, password, user.hashed_password
+    )
+    if not verified:
         return None
+    if updated_hash is not None:
+        fake_db[username]["hashed_password"] = updated_hash
+        user_cache.pop(username, None)
+        user = get_user(fake_db, username)
     return user
 
 
-def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+def b64url_encode(data: bytes) -> bytes:
+    return urlsafe_b64encode(data).rstrip(b"=")
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_schema)]) -> UserInDB:
-    credentials_exception = HTTPException(
+def b64url_decode(data: bytes) -> bytes:
+    return urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+def sign_jwt(signing_input: bytes) -> bytes:
+    return b64url_encode(hmac.new(JWT_KEY, signing_input, hashlib.sha256).digest())
+
+
+def create_access_token(
+    data: dict, expires_in: int = DEFAULT_TOKEN_EXPIRE_SECONDS
+) -> str:
+    to_encode = data.copy()
+    to_encode["exp"] = int(time.time()) + expires_in
+    payload = orjson.dumps(to_encode)
+    signing_input = JWT_HEADER_SEGMENT + b"." + b64url_encode(payload)
+    encoded_jwt = signing_input + b"." + sign_jwt(signing_input)
+    return encoded_jwt.decode("ascii")
+
+
+def decode_access_token(token: str) -> dict:
+    if len(token) > JWT_MAX_LENGTH:
+        raise ValueError("Token is too long")
+    signing_input, _, signature = token.encode("ascii").rpartition(b".")
+    header, _, payload = signing_input.partition(b".")
+    if header != JWT_HEADER_SEGMENT:
+        raise ValueError("Unsupported token header")
+    if not hmac.compare_digest(signature, sign_jwt(signing_input)):
+        raise ValueError("Signature verification failed")
+    claims = orjson.loads(b64url_decode(payload))
+    if not isinstance(claims, dict):
+        raise ValueError("Invalid token payload")
+    exp = claims.get("exp")
+    if not isinstance(exp, int) or exp <= time.time():
+        raise ValueError("Token has expired")
+    if not isinstance(claims.get("sub"), str):
+        raise ValueError("Token has no subject")
+    return claims
+
+
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def get_user_from_token(token: str) -> UserInDB:
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except jwt.InvalidTokenError:
-        raise credentials_exception
-    user = get_user(fake_users_db, username=token_data.username)
+        payload = decode_access_token(token)
+        username = payload["sub"]
+    except ValueError:
+        raise credentials_exception()
+    user = get_user(fake_users_db, username=username)
     if not user:
-        raise credentials_exception
+        raise credentials_exception()
     return user
 
 
-async def get_current_active_user(
-    current_user: Annotated[User, Depends(get_current_user)],
-) -> User:
-    if current_user.disabled:
+async def get_active_user(token: Annotated[str, Depends(oauth2_schema)]) -> User:
+    # Decoding is a single HMAC plus a dict lookup, far cheaper than a threadpool
+    # hop, so keep it inline. Don't wrap it in run_in_threadpool like Argon2.
+    user = get_user_from_token(token)
+    if user.disabled:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive user"
         )
-    return current_user
+    return user
+
+
+@deprecated("Use get_active_user instead")
+async def get_current_user(token: Annotated[str, Depends(oauth2_schema)]) -> UserInDB:
+    return get_user_from_token(token)
+
+
+@deprecated("Use get_active_user instead")
+async def get_current_active_user(
+    token: Annotated[str, Depends(oauth2_schema)],
+) -> User:
+    return await get_active_user(token)
 
 
-@app.post("/token", response_model=Token)
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    user = authenticate_user(fake_users_db, form_data.username, form_data.password)
+def validate_login_form(fields: Mapping) -> LoginForm:
+    try:
+        return LoginForm.model_validate(fields)
+    except ValidationError as exc:
+        raise RequestValidationError(
+            [
+                {**error, "loc": ("body", *error["loc"])}
+                for error in exc.errors(include_url=False, include_input=False)
+            ]
+        )
+
+
+async def read_login_form(request: Request) -> LoginForm:
+    # OAuth2 clients post application/x-www-form-urlencoded, parse that straight
+    # from the body and only go through Starlette's form parser for multipart.
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        body = await request.body()
+        try:
+            fields = parse_qsl(
+                body.decode("latin-1"), max_num_fields=LOGIN_FORM_MAX_FIELDS
+            )
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Too many fields. Maximum number of fields is "
+                f"{LOGIN_FORM_MAX_FIELDS}.",
+            )
+        return validate_login_form(dict(fields))
+    async with request.form() as form:
+        return validate_login_form(
+            {key: value for key, value in form.items() if value != ""}
+        )
+
+
+LOGIN_FORM_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            media_type: {"schema": LoginForm.model_json_schema()}
+            for media_type in (
+                "application/x-www-form-urlencoded",
+                "multipart/form-data",
+            )
+        },
+    }
+}
+
+# Shared aliases so routes don't repeat the same Depends(...) declarations.
+LoginFormData = Annotated[LoginForm, Depends(read_login_form)]
+ActiveUser = Annotated[User, Depends(get_active_user)]
+
+
+@app.post("/token", response_model=Token, openapi_extra=LOGIN_FORM_OPENAPI)
+async def login(form_data: LoginFormData):
+    user = await authenticate_user(
+        fake_users_db, form_data.username, form_data.password
+    )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Beaere"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username}, expires_in=ACCESS_TOKEN_EXPIRE_SECONDS
     )
     return Token(access_token=access_token, token_type="bearer")
 
 
-@app.get("/users/me", response_model=User)
+# Return the public fields directly rather than re-validating UserInDB through
+# response_model; `responses` keeps the User schema in the OpenAPI docs.
+@app.get("/users/me", responses={status.HTTP_200_OK: {"model": User}})
 async def read_users_me(
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: ActiveUser,
 ):
-    return current_user
+    return {
+        "username": current_user.username,
+        "email": current_user.email,
+        "full_name": current_user.full_name,
+        "disabled": current_user.disabled,
+    }
 
 
 @app.get("/users/me/items")
 async def read_own_items(
-    current_user: Annotated[User, Depends(get_current_active_user)],
+    current_user: ActiveUser,
 ):
     return [{"item_id": "Foo", "owner": current_user.username}]
 